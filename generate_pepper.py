@@ -5,6 +5,7 @@ Este script genera una clave criptográfica segura y la almacena en el archivo .
 para que sea utilizada por la aplicación como pepper en el hash de contraseñas.
 """
 
+import base64
 import os
 import secrets
 from pathlib import Path
@@ -14,19 +15,29 @@ def generate_pepper(length: int = 32) -> str:
     """
     Genera una clave aleatoria segura usando secrets.
 
+    Se obtienen `length` bytes crudos del CSPRNG del sistema y se codifican
+    en base64 URL-safe solo para poder persistirlos en el archivo .env;
+    la aplicación los decodifica de vuelta a bytes en el arranque.
+
     Args:
-        length: Longitud de la clave en caracteres (por defecto 32)
+        length: Cantidad de bytes aleatorios a generar (por defecto 32)
 
     Returns:
         Una cadena codificada en base64 segura para URLs
     """
-    return secrets.token_urlsafe(length)
+    raw = secrets.token_bytes(length)
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
 
 
 def create_env_file(pepper: str, env_path: str = ".env") -> bool:
     """
     Crea o actualiza el archivo .env con la variable APP_PEPPER.
 
+    La actualización se hace en una sola pasada sobre un archivo temporal que
+    luego reemplaza a .env con os.replace: la escritura es atómica (nunca
+    queda un .env a medias visible para otros procesos) y la memoria usada no
+    depende del tamaño del archivo. El archivo final queda con permisos 0600.
+
     Args:
         pepper: El valor del pepper a almacenar
         env_path: Ruta del archivo .env (por defecto ".env")
@@ -36,25 +47,25 @@ def create_env_file(pepper: str, env_path: str = ".env") -> bool:
     """
     try:
         env_file = Path(env_path)
-
-        # Leer contenido existente si el archivo existe
-        existing_content = ""
-        if env_file.exists():
-            with open(env_file, "r", encoding="utf-8") as f:
-                existing_content = f.read()
-
-        # Preparar el nuevo contenido
-        lines = existing_content.strip().split("\n") if existing_content.strip() else []
-
-        # Remover línea existente de APP_PEPPER si la hay
-        lines = [line for line in lines if not line.startswith("APP_PEPPER=")]
-
-        # Agregar el nuevo APP_PEPPER
-        lines.append(f"APP_PEPPER={pepper}")
-
-        # Escribir el archivo actualizado
-        with open(env_file, "w", encoding="utf-8") as f:
-            f.write("\n".join(lines) + "\n")
+        tmp_path = env_path + ".tmp"
+
+        # El temporal nace con permisos 0600: el secreto nunca es legible por
+        # otros usuarios, ni siquiera si el proceso muere antes del replace.
+        tmp_fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(tmp_fd, "w", encoding="utf-8") as out:
+            # Copiar el contenido existente, omitiendo el APP_PEPPER anterior
+            if env_file.exists():
+                with open(env_file, "r", encoding="utf-8") as f:
+                    for line in f:
+                        if line.startswith("APP_PEPPER="):
+                            continue
+                        out.write(line if line.endswith("\n") else line + "\n")
+
+            # Agregar el nuevo APP_PEPPER al final
+            out.write(f"APP_PEPPER={pepper}\n")
+
+        os.replace(tmp_path, env_path)
+        os.chmod(env_path, 0o600)
 
         return True
 
@@ -77,7 +88,8 @@ def create_env_example(env_path: str = ".env.example") -> bool:
         example_content = """# Variables de entorno para la aplicación de autenticación
 
 # APP_PEPPER: Clave secreta utilizada como "pepper" en el hash de contraseñas
-# Esta clave se concatena a la contraseña del usuario antes de aplicar Argon2id
+# Esta clave se usa como clave de BLAKE2b para pre-hashear la contraseña del
+# usuario antes de aplicar Argon2id
 # Generar una clave segura con: python generate_pepper.py
 # IMPORTANTE: Nunca compartir esta clave o incluirla en repositorios públicos
 APP_PEPPER=tu_clave_super_secreta_de_32_caracteres_aqui